@@ -1,12 +1,12 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.ndimage.interpolation import map_coordinates
+from scipy.ndimage import uniform_filter1d
 from scipy.interpolate import CubicSpline
 from scipy.special import erf
-from skimage import io
+import tifffile
 import cv2
 import glob
-import copy
 import os
 from .roi import offset_coordinates
 
@@ -22,7 +22,7 @@ def load_image(filename):
     :return:
     """
 
-    return io.imread(filename).astype(float)
+    return tifffile.imread(filename).astype(np.float32)
 
 
 def save_img(img, direc):
@@ -34,7 +34,7 @@ def save_img(img, direc):
     :return:
     """
 
-    io.imsave(direc, img.astype('float32'))
+    tifffile.imwrite(direc, img.astype('float32'), compression='zlib')
 
 
 def save_img_jpeg(img, direc, cmin=None, cmax=None, cmap='gray'):
@@ -53,8 +53,12 @@ def save_img_jpeg(img, direc, cmin=None, cmax=None, cmap='gray'):
 
 ########### IMAGE OPERATIONS ###########
 
+# OpenCV interpolation flags, by interp name and by spline order
+_cv2_interp = {'linear': cv2.INTER_LINEAR, 'cubic': cv2.INTER_CUBIC}
+_cv2_order = {0: cv2.INTER_NEAREST, 1: cv2.INTER_LINEAR, 3: cv2.INTER_CUBIC}
 
-def straighten(img, roi, thickness, interp='cubic', ninterp=None):
+
+def straighten(img, roi, thickness, interp='cubic', ninterp=None, periodic=True):
     """
     Creates straightened image based on coordinates
 
@@ -63,34 +67,63 @@ def straighten(img, roi, thickness, interp='cubic', ninterp=None):
     :param img:
     :param roi: Coordinates. Should be 1 pixel length apart in a loop
     :param thickness:
+    :param periodic: True if coordinates form a closed loop
     :return:
 
     """
 
+    gridcoors_x, gridcoors_y = compute_sampling_grid(roi, thickness, ninterp, periodic)
+    return sample_grid(img, gridcoors_x, gridcoors_y, interp)
+
+
+def compute_sampling_grid(roi, thickness, ninterp=None, periodic=True):
+    """
+    Computes the image coordinates sampled by straighten: ninterp points along the normal at each ROI coordinate
+
+    :param roi: Coordinates. Should be 1 pixel length apart in a loop
+    :param thickness:
+    :param ninterp:
+    :param periodic: True if coordinates form a closed loop
+    :return: x and y coordinate grids, shape (ninterp, len(roi))
+
+    """
+
     if ninterp is None:
         ninterp = thickness
 
-    # Calculate gradients
+    # Unit normals from centred differences (around the loop if periodic, one-sided at the ends otherwise)
     xcoors = roi[:, 0]
     ycoors = roi[:, 1]
-    ydiffs = np.diff(ycoors, prepend=ycoors[-1])
-    xdiffs = np.diff(xcoors, prepend=xcoors[-1])
-    grad = ydiffs / xdiffs
-    tangent_grad = -1 / grad
-
-    # Get interpolation coordinates
-    offsets = np.linspace(thickness / 2, -thickness / 2, ninterp)
-    xchange = ((offsets ** 2)[np.newaxis, :] / (1 + tangent_grad ** 2)[:, np.newaxis]) ** 0.5
-    ychange = xchange / abs(grad)[:, np.newaxis]
-    gridcoors_x = xcoors[:, np.newaxis] + np.sign(ydiffs)[:, np.newaxis] * np.sign(offsets)[np.newaxis, :] * xchange
-    gridcoors_y = ycoors[:, np.newaxis] - np.sign(xdiffs)[:, np.newaxis] * np.sign(offsets)[np.newaxis, :] * ychange
-
-    # Interpolate
-    if interp == 'linear':
-        straight = map_coordinates(img.T, [gridcoors_x, gridcoors_y], order=1, mode='nearest')
-    elif interp == 'cubic':
-        straight = map_coordinates(img.T, [gridcoors_x, gridcoors_y], order=3, mode='nearest')
-    return straight.astype(np.float64).T
+    if periodic:
+        xdiffs, ydiffs = (np.roll(roi, -1, axis=0) - np.roll(roi, 1, axis=0)).T
+    else:
+        xdiffs, ydiffs = np.gradient(roi, axis=0).T
+    length = np.hypot(xdiffs, ydiffs)
+    xnormal = ydiffs / length
+    ynormal = -xdiffs / length
+
+    # Get interpolation coordinates: each point offset along its normal (outer product)
+    offsets = np.linspace(thickness / 2, -thickness / 2, ninterp)[:, np.newaxis]
+    gridcoors_x = xcoors + offsets * xnormal
+    gridcoors_y = ycoors + offsets * ynormal
+    return gridcoors_x.astype(np.float32), gridcoors_y.astype(np.float32)
+
+
+def sample_grid(img, gridcoors_x, gridcoors_y, interp='cubic', out=None):
+    """
+    Samples image at coordinate grids from compute_sampling_grid, returning the straightened image
+
+    :param img:
+    :param gridcoors_x:
+    :param gridcoors_y:
+    :param interp: interpolation type (linear or cubic)
+    :param out: optional float32 array of the grid shape to write the result into
+    :return:
+
+    """
+
+    return cv2.remap(img.astype(np.float32, copy=False), gridcoors_x, gridcoors_y, dst=out,
+                     interpolation=_cv2_interp[interp], borderMode=cv2.BORDER_REPLICATE)
 
 
 def polycrop(img, polyline, enlarge):
@@ -105,9 +138,9 @@ def polycrop(img, polyline, enlarge):
     """
 
     newcoors = np.int32(offset_coordinates(polyline, enlarge * np.ones([len(polyline[:, 0])])))
-    mask = np.zeros(img.shape)
-    mask = cv2.fillPoly(mask, [newcoors], 1)
-    newimg = img * mask
+    mask = np.zeros(img.shape, np.uint8)
+    cv2.fillPoly(mask, [newcoors], 1)
+    newimg = np.where(mask, img, 0)
     return newimg
 
 
@@ -122,7 +155,8 @@ def rotated_embryo(img, roi, l=None, h=None, order=1, return_roi=False):
     """
 
     # PCA on ROI coordinates
-    [latent, coeff] = np.linalg.eig(np.cov(roi.T))
+    centred = roi - roi.mean(axis=0)
+    latent, coeff = _eig2x2(np.dot(centred.T, centred) / (len(roi) - 1))
 
     # Transform ROI
     roi_transformed = np.dot(coeff.T, roi.T)
@@ -150,7 +184,12 @@ def rotated_embryo(img, roi, l=None, h=None, order=1, return_roi=False):
     yvals_back_grid = np.reshape(yvals_back, [len(yvals), len(xvals)])
 
     # Map coordinates using linear interpolation
-    zvals = map_coordinates(img.T, [xvals_back_grid, yvals_back_grid], order=order)
+    if order in _cv2_order:
+        zvals = cv2.remap(img.astype(np.float32, copy=False), xvals_back_grid.astype(np.float32),
+                          yvals_back_grid.astype(np.float32), interpolation=_cv2_order[order],
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    else:
+        zvals = map_coordinates(img.T, [xvals_back_grid, yvals_back_grid], order=order)
 
     # Force posterior on right
     if roi_transformed[0, 0] < roi_transformed[0, roi_transformed.shape[1] // 2]:
@@ -164,14 +203,37 @@ def rotated_embryo(img, roi, l=None, h=None, order=1, return_roi=False):
 
 
 def bg_subtraction(img, roi, band=(25, 75)):
-    a = polycrop(img, roi, band[1]) - polycrop(img, roi, band[0])
-    a = [np.nanmean(a[np.nonzero(a)])]
-    return img - a
+    """
+    Subtracts background, estimated as the mean intensity in a band between band[0] and band[1] pixels outside the ROI
+
+    """
+
+    mask = np.zeros(img.shape, np.uint8)
+    cv2.fillPoly(mask, [np.int32(offset_coordinates(roi, band[1] * np.ones([len(roi[:, 0])])))], 1)
+    cv2.fillPoly(mask, [np.int32(offset_coordinates(roi, band[0] * np.ones([len(roi[:, 0])])))], 0)
+    return img - img[mask.astype(bool)].mean()
 
 
 ########### ROI OPERATIONS ###########
 
 
+def _eig2x2(cov):
+    """
+    Closed-form eigendecomposition of a 2x2 covariance matrix
+
+    :param cov:
+    :return: eigenvalues (largest first), and eigenvectors as columns of a rotation matrix (long axis first)
+
+    """
+
+    a, b, d = cov[0, 0], cov[0, 1], cov[1, 1]
+    theta = 0.5 * np.arctan2(2 * b, a - d)
+    c, s = np.cos(theta), np.sin(theta)
+    coeff = np.array([[c, -s], [s, c]])
+    latent = (a + d) / 2 + np.array([1, -1]) * np.hypot((a - d) / 2, b)
+    return latent, coeff
+
+
 def rotate_roi(roi):
     """
     Rotates coordinate array so that most posterior point is at the beginning
@@ -179,13 +241,13 @@ def rotate_roi(roi):
     """
 
     # PCA to find long axis
-    M = (roi - np.mean(roi.T, axis=1)).T
-    [latent, coeff] = np.linalg.eig(np.cov(M))
-    score = np.dot(coeff.T, M)
+    centred = roi - roi.mean(axis=0)
+    latent, coeff = _eig2x2(np.dot(centred.T, centred) / (len(roi) - 1))
+    score = np.dot(centred, coeff)
 
     # Find most extreme points
-    a = np.argmin(np.minimum(score[0, :], score[1, :]))
-    b = np.argmax(np.maximum(score[0, :], score[1, :]))
+    a = np.argmin(np.minimum(score[:, 0], score[:, 1]))
+    b = np.argmax(np.maximum(score[:, 0], score[:, 1]))
 
     # Find the one closest to user defined posterior
     dista = np.hypot((roi[0, 0] - roi[a, 0]), (roi[0, 1] - roi[a, 1]))
@@ -209,12 +271,12 @@ def norm_roi(roi):
     """
 
     # PCA
-    M = (roi - np.mean(roi.T, axis=1)).T
-    [latent, coeff] = np.linalg.eig(np.cov(M))
-    score = np.dot(coeff.T, M).T
+    centred = roi - roi.mean(axis=0)
+    latent, coeff = _eig2x2(np.dot(centred.T, centred) / (len(roi) - 1))
+    score = np.dot(centred, coeff)
 
     # Find long axis
-    if (max(score[0, :]) - min(score[0, :])) < (max(score[1, :]) - min(score[1, :])):
+    if (max(score[:, 0]) - min(score[:, 0])) < (max(score[:, 1]) - min(score[:, 1])):
         score = np.fliplr(score)
 
     return score
@@ -249,22 +311,37 @@ def interp_2d_array(array, n, ax=1, method='cubic'):
     :param ax:
     :return:
 
-    Todo: no loops
-
     """
 
-    if ax == 1:
-        interped = np.zeros([n, len(array[0, :])])
-        for x in range(len(array[0, :])):
-            interped[:, x] = interp_1d_array(array[:, x], n, method)
-        return interped
-    elif ax == 0:
-        interped = np.zeros([len(array[:, 0]), n])
-        for x in range(len(array[:, 0])):
-            interped[x, :] = interp_1d_array(array[x, :], n, method)
-        return interped
-    else:
+    if ax not in (0, 1):
         return None
+    axis = 1 - ax
+    n_in = array.shape[axis]
+    positions = np.linspace(0, n_in - 1, n)
+
+    if method == 'linear':
+        i = positions.astype(int)
+        w = np.expand_dims(positions - i, ax)
+        lower = np.take(array, i, axis=axis)
+        upper = np.take(array, np.clip(i + 1, 0, n_in - 1), axis=axis)
+        return lower + w * (upper - lower)
+    elif method == 'cubic':
+        return CubicSpline(np.arange(n_in), array, axis=axis)(positions)
+
+
+def interp_matrix(n_in, n, method='cubic'):
+    """
+    Matrix that interpolates a length n_in array into n points (as interp_1d_array), for reuse across many arrays of
+    the same length: interp_matrix(len(a), n) @ a == interp_1d_array(a, n)
+
+    :param n_in:
+    :param n:
+    :param method:
+    :return: (n, n_in) array
+
+    """
+
+    return interp_2d_array(np.eye(n_in), n, method=method)
 
 
 def rolling_ave_1d(array, window, periodic=True):
@@ -278,33 +355,31 @@ def rolling_ave_1d(array, window, periodic=True):
     """
     if window == 1:
         return array
-    if not periodic:
-        array_padded = np.r_[array[:int(window / 2)][::-1], array, array[-int(window / 2):][::-1]]
-    else:
-        array_padded = np.r_[array[-int(window / 2):], array, array[:int(window / 2)]]
-    cumsum = np.cumsum(array_padded)
-    return (cumsum[window:] - cumsum[:-window]) / window
+    return uniform_filter1d(array, size=window, output=np.result_type(array, np.float32),
+                            mode='wrap' if periodic else 'reflect', origin=(window % 2) - 1)
 
 
-def rolling_ave_2d(array, window, periodic=True):
+def rolling_ave_2d(array, window, periodic=True, output=None):
     """
     Returns rolling average across the x axis of an image (used for straightened profiles)
 
     :param array: image data
     :param window: number of pixels to average over. Odd number is best
     :param periodic: is true, rolls over at ends
+    :param output: optional array to write the result into
     :return: ave
 
     """
 
     if window == 1:
-        return array
-    if not periodic:
-        array_padded = np.c_[array[:, :int(window / 2)][:, :-1], array, array[:, -int(window / 2):][:, :-1]]
-    else:
-        array_padded = np.c_[array[:, -int(window / 2):], array, array[:, :int(window / 2)]]
-    cumsum = np.cumsum(array_padded, axis=1)
-    return (cumsum[:, window:] - cumsum[:, :-window]) / window
+        if output is None:
+            return array
+        np.copyto(output, array)
+        return output
+    if output is None:
+        output = np.result_type(array, np.float32)
+    return uniform_filter1d(array, size=window, axis=1, output=output, mode='wrap' if periodic else 'reflect',
+                            origin=(window % 2) - 1)
 
 
 def bounded_mean_1d(array, bounds, weights=None):
@@ -387,7 +462,9 @@ def calc_asi(mems, size=0.33):
 
 
 def make_mask(shape, roi):
-    return cv2.fillPoly(np.zeros(shape) * np.nan, [np.int32(roi)], 1)
+    mask = np.zeros(shape, np.uint8)
+    cv2.fillPoly(mask, [np.int32(roi)], 1)
+    return np.where(mask, 1.0, np.nan)
 
 
 def readnd(path):
@@ -424,36 +501,27 @@ def organise_by_nd(path):
             os.rename(file, '%s/%s/%s' % (path, folder, os.path.basename(os.path.normpath(file))))
 
 
-def _direcslist(dest, levels=0, exclude=('!',), exclusive=None):
-    lis = sorted(glob.glob('%s/*/' % dest))
+def _subdirecs(dest):
+    try:
+        return [e.path for e in os.scandir(dest) if e.is_dir() and not e.name.startswith('.')]
+    except OSError:
+        return []
 
+
+def _direcslist(dest, levels=0, exclude=('!',), exclusive=None):
+    lis = _subdirecs(dest)
     for level in range(levels):
-        newlis = []
-        for e in lis:
-            newlis.extend(sorted(glob.glob('%s/*/' % e)))
-        lis = newlis
-        lis = [x[:-1] for x in lis]
+        lis = [x for e in lis for x in _subdirecs(e)]
 
     # Excluded directories
-    lis_copy = copy.deepcopy(lis)
     if exclude is not None:
-        for x in lis:
-            for i in exclude:
-                if i in x:
-                    lis_copy.remove(x)
-                    break
+        lis = [x for x in lis if not any(i in x for i in exclude)]
 
     # Exclusive directories
     if exclusive is not None:
-        lis2 = []
-        for x in lis_copy:
-            for i in exclusive:
-                if i in x:
-                    lis2.append(x)
-    else:
-        lis2 = lis_copy
+        lis = [x for x in lis if any(i in x for i in exclusive)]
 
-    return sorted(lis2)
+    return sorted(lis)
 
 
 def direcslist(dest, levels=0, exclude=('!',), exclusive=None):
@@ -1,9 +1,7 @@
 import numpy as np
-from scipy.optimize import differential_evolution
-from joblib import Parallel, delayed
-import multiprocessing
 import os
-from .funcs import straighten, rolling_ave_2d, interp_1d_array, interp_2d_array, rotate_roi, save_img, error_func, gaus
+from .funcs import compute_sampling_grid, sample_grid, rolling_ave_2d, interp_1d_array, interp_2d_array, \
+    interp_matrix, rotate_roi, save_img, error_func, gaus
 from .roi import interp_roi, offset_coordinates, spline_roi
 
 
@@ -32,17 +30,19 @@ class ImageQuant:
     bg_subtract        if True, will estimate and subtract background signal prior to quantification
 
     Computation:
-    parallel           TRUE = perform fitting in parallel
-    cores              number of cores to use if parallel is True (if none will use all available)
+    parallel           no longer used (all profiles are fit together in one vectorised step), kept for compatibility
+    cores              no longer used, kept for compatibility
 
     Saving:
     save_path          destination to save results, will create if it doesn't already exist
+    save_txt           if True, also saves offsets, cyts, mems and roi as individual .txt files (legacy format)
 
     """
 
     def __init__(self, img, sigma=None, roi=None, freedom=0.5,
                  periodic=True, thickness=50, itp=10, rol_ave=10, parallel=False, cores=None, rotate=False,
-                 zerocap=True, nfits=None, iterations=2, interp='cubic', save_path=None, bg_subtract=False):
+                 zerocap=True, nfits=None, iterations=2, interp='cubic', save_path=None, bg_subtract=False,
+                 save_txt=False):
 
         # Image / stackm
         self.img = img
@@ -51,6 +51,8 @@ class ImageQuant:
         self.roi_init = roi
         self.roi = roi
         self.periodic = periodic
+        self._gridcoors = None
+        self._grid_roi = None
 
         # Background subtraction
         self.bg_subtract = bg_subtract
@@ -70,6 +72,7 @@ class ImageQuant:
 
         # Saving
         self.save_path = save_path
+        self.save_txt = save_txt
 
         # Background curves
         self.cytbg = (1 + error_func(np.arange(thickness * 2), thickness, self.sigma)) / 2
@@ -78,12 +81,26 @@ class ImageQuant:
         self.membg = gaus(np.arange(thickness * 2), thickness, self.sigma)
         self.membg_itp = gaus(np.arange(2 * self.thickness_itp), self.thickness_itp, self.sigma * self.itp)
 
+        # Fitting basis: background curves sliced at every allowed offset (itp units), with their inner products
+        self._offsets_itp = np.arange(int((self.thickness_itp / 2) * (1 - self.freedom)),
+                                      int((self.thickness_itp / 2) * (1 + self.freedom)) + 1)
+        idx = self._offsets_itp[np.newaxis, :] + np.arange(self.thickness_itp)[:, np.newaxis]
+        self._cyt_basis = self.cytbg_itp[idx]
+        self._mem_basis = self.membg_itp[idx]
+        gcc = np.sum(self._cyt_basis ** 2, axis=0)[:, np.newaxis]
+        gmm = np.sum(self._mem_basis ** 2, axis=0)[:, np.newaxis]
+        gcm = np.sum(self._cyt_basis * self._mem_basis, axis=0)[:, np.newaxis]
+        det = gcc * gmm - gcm ** 2
+        self._gram_inv = (gmm / det, -gcm / det, gcc / det)
+        self._gcc_inv = 1 / gcc
+        self._gmm_inv = 1 / gmm
+
+        # Interpolation from fitting resolution back to image resolution, for simulated images
+        self._interp_down = interp_matrix(self.thickness_itp, self.thickness, method=self.interp).astype(np.float32)
+
         # Computation
         self.parallel = parallel
-        if cores is not None:
-            self.cores = cores
-        else:
-            self.cores = multiprocessing.cpu_count()
+        self.cores = cores
 
         # Results containers
         self.offsets = None
@@ -102,6 +119,7 @@ class ImageQuant:
         self.straight_resids = None
         self.straight_resids_pos = None
         self.straight_resids_neg = None
+        self._buffer = None
 
         if self.roi is not None:
             self.reset_res()
@@ -134,7 +152,10 @@ class ImageQuant:
             self.nfits = len(self.roi[:, 0])
 
         # Straighten image
-        self.straight = straighten(self.img, self.roi, self.thickness)
+        if self._gridcoors is None or self._grid_roi is not self.roi:
+            self._gridcoors = compute_sampling_grid(self.roi, self.thickness, periodic=self.periodic)
+            self._grid_roi = self.roi
+        sample_grid(self.img, *self._gridcoors, interp=self.interp, out=self.straight)
 
         # Background subtract
         if self.bg_subtract:
@@ -144,48 +165,61 @@ class ImageQuant:
 
         # Smoothen
         if self.rol_ave != 0:
-            self.straight_filtered = rolling_ave_2d(self.straight, self.rol_ave, self.periodic)
+            rolling_ave_2d(self.straight, self.rol_ave, self.periodic, output=self.straight_filtered)
         else:
-            self.straight_filtered = self.straight
+            np.copyto(self.straight_filtered, self.straight)
 
         # Interpolate
         straight = interp_2d_array(self.straight_filtered, self.thickness_itp, method=self.interp)
         straight = interp_2d_array(straight, self.nfits, ax=0, method=self.interp)
 
         # Fit
-        if self.parallel:
-            results = np.array(Parallel(n_jobs=self.cores)(
-                delayed(self._fit_profile)(straight[:, x]) for x in range(len(straight[0, :]))))
-            self.offsets = results[:, 0]
-            self.cyts = results[:, 1]
-            self.mems = results[:, 2]
-        else:
-            for x in range(len(straight[0, :])):
-                self.offsets[x], self.cyts[x], self.mems[x] = self._fit_profile(straight[:, x])
+        self.offsets, self.cyts, self.mems = self._fit_profiles(straight)
 
         # Interpolate
         self.offsets_full = interp_1d_array(self.offsets, len(self.roi[:, 0]), method='linear')
         self.cyts_full = interp_1d_array(self.cyts, len(self.roi[:, 0]), method='linear')
         self.mems_full = interp_1d_array(self.mems, len(self.roi[:, 0]), method='linear')
 
-    def _fit_profile(self, profile):
+    def _fit_profiles(self, straight):
+        """
+        Fits every profile (column) at every allowed offset by linear least squares on the cytoplasmic and membrane
+        curves, and returns the offset with the lowest sum of squared errors for each
+
+        """
+
+        # Unconstrained solution at each offset (rows) for each profile (columns), accumulated in place
+        icc, icm, imm = self._gram_inv
+        cp = np.dot(self._cyt_basis.T, straight)
+        mp = np.dot(self._mem_basis.T, straight)
+        c = icc * cp
+        c += icm * mp
+        m = imm * mp
+        m += icm * cp
+        pp = np.sum(straight ** 2, axis=0)
+        sse = c * cp
+        sse += m * mp
+        np.subtract(pp, sse, out=sse)
+
+        # Zerocap: where a component is negative, the optimum lies on the boundary (one component only)
         if self.zerocap:
-            bounds = (
-                ((self.thickness_itp / 2) * (1 - self.freedom), (self.thickness_itp / 2) * (1 + self.freedom)),
-                (0, max(2 * max(profile), 0)), (0, max(2 * max(profile), 0)))
-        else:
-            bounds = (
-                ((self.thickness_itp / 2) * (1 - self.freedom), (self.thickness_itp / 2) * (1 + self.freedom)),
-                (-0.2 * max(profile), 2 * max(profile)), (-0.2 * max(profile), 2 * max(profile)))
-        res = differential_evolution(self._mse, bounds=bounds, args=(profile,), tol=0.2)
-        o = (res.x[0] - self.thickness_itp / 2) / self.itp
-        return o, res.x[1], res.x[2]
-
-    def _mse(self, l_c_m, profile):
-        l, c, m = l_c_m
-        y = (c * self.cytbg_itp[int(l):int(l) + self.thickness_itp]) + (
-                m * self.membg_itp[int(l):int(l) + self.thickness_itp])
-        return np.mean((profile - y) ** 2)
+            infeasible = (c < 0) | (m < 0)
+            c_only = np.maximum(cp * self._gcc_inv, 0)
+            m_only = np.maximum(mp * self._gmm_inv, 0)
+            sse_c = pp - c_only * cp
+            sse_m = pp - m_only * mp
+            use_c = sse_c <= sse_m
+            c_only[~use_c] = 0
+            m_only[use_c] = 0
+            np.minimum(sse_c, sse_m, out=sse_c)
+            np.copyto(c, c_only, where=infeasible)
+            np.copyto(m, m_only, where=infeasible)
+            np.copyto(sse, sse_c, where=infeasible)
+
+        i = np.argmin(sse, axis=0)
+        x = np.arange(straight.shape[1])
+        offsets = (self._offsets_itp[i] - self.thickness_itp / 2) / self.itp
+        return offsets, c[i, x], m[i, x]
 
     """
     Misc
@@ -197,20 +231,20 @@ class ImageQuant:
         Creates simulated images based on fit results
 
         """
-        for x in range(len(self.roi[:, 0])):
-            c = self.cyts_full[x]
-            m = self.mems_full[x]
-            l = int(self.offsets_full[x] * self.itp + (self.thickness_itp / 2))
-            self.straight_cyt[:, x] = interp_1d_array(c * self.cytbg_itp[l:l + self.thickness_itp], self.thickness,
-                                                      method=self.interp)
-            self.straight_mem[:, x] = interp_1d_array(m * self.membg_itp[l:l + self.thickness_itp], self.thickness,
-                                                      method=self.interp)
-            self.straight_fit[:, x] = interp_1d_array(
-                (c * self.cytbg_itp[l:l + self.thickness_itp]) + (m * self.membg_itp[l:l + self.thickness_itp]),
-                self.thickness, method=self.interp)
-            self.straight_resids[:, x] = self.straight[:, x] - self.straight_fit[:, x]
-            self.straight_resids_pos[:, x] = np.clip(self.straight_resids[:, x], a_min=0, a_max=None)
-            self.straight_resids_neg[:, x] = abs(np.clip(self.straight_resids[:, x], a_min=None, a_max=0))
+
+        l = (self.offsets_full * self.itp + (self.thickness_itp / 2)).astype(int)
+        idx = l[np.newaxis, :] + np.arange(self.thickness_itp)[:, np.newaxis]
+        cyt = np.multiply(self.cyts_full, self.cytbg_itp[idx], dtype=np.float32)
+        mem = np.multiply(self.mems_full, self.membg_itp[idx], dtype=np.float32)
+        np.dot(self._interp_down, cyt, out=self.straight_cyt)
+        np.dot(self._interp_down, mem, out=self.straight_mem)
+        np.add(self.straight_cyt, self.straight_mem, out=self.straight_fit)
+
+        # Residuals, written in place
+        np.subtract(self.straight, self.straight_fit, out=self.straight_resids)
+        np.maximum(self.straight_resids, 0, out=self.straight_resids_pos)
+        np.negative(self.straight_resids, out=self.straight_resids_neg)
+        np.maximum(self.straight_resids_neg, 0, out=self.straight_resids_neg)
 
     def adjust_roi(self):
         """
@@ -233,6 +267,10 @@ class ImageQuant:
             if self.rotate:
                 self.roi = rotate_roi(self.roi)
 
+        # Sampling grid for straightening
+        self._gridcoors = compute_sampling_grid(self.roi, self.thickness, periodic=self.periodic)
+        self._grid_roi = self.roi
+
     def reset(self):
         """
         Resets entire class to its initial state
@@ -261,15 +299,15 @@ class ImageQuant:
         self.cyts_full = np.zeros(len(self.roi[:, 0]))
         self.mems_full = np.zeros(len(self.roi[:, 0]))
 
-        # Simulated images
-        self.straight = np.zeros([self.thickness, len(self.roi[:, 0])])
-        self.straight_filtered = np.zeros([self.thickness, len(self.roi[:, 0])])
-        self.straight_fit = np.zeros([self.thickness, len(self.roi[:, 0])])
-        self.straight_mem = np.zeros([self.thickness, len(self.roi[:, 0])])
-        self.straight_cyt = np.zeros([self.thickness, len(self.roi[:, 0])])
-        self.straight_resids = np.zeros([self.thickness, len(self.roi[:, 0])])
-        self.straight_resids_pos = np.zeros([self.thickness, len(self.roi[:, 0])])
-        self.straight_resids_neg = np.zeros([self.thickness, len(self.roi[:, 0])])
+        # Simulated images: views into one buffer that is kept across iterations (grown if the ROI gets longer)
+        size = self.thickness * len(self.roi[:, 0])
+        if self._buffer is None or self._buffer.shape[1] < size:
+            self._buffer = np.zeros([8, 2 * size], dtype=np.float32)
+        else:
+            self._buffer[:, :size].fill(0)
+        (self.straight, self.straight_filtered, self.straight_fit, self.straight_mem, self.straight_cyt,
+         self.straight_resids, self.straight_resids_pos, self.straight_resids_neg) = \
+            self._buffer[:, :size].reshape([8, self.thickness, len(self.roi[:, 0])])
 
     def save(self):
         """
@@ -280,10 +318,13 @@ class ImageQuant:
         if not os.path.isdir(self.save_path):
             os.mkdir(self.save_path)
 
-        np.savetxt(self.save_path + '/offsets.txt', self.offsets, fmt='%.4f', delimiter='\t')
-        np.savetxt(self.save_path + '/cyts.txt', self.cyts, fmt='%.4f', delimiter='\t')
-        np.savetxt(self.save_path + '/mems.txt', self.mems, fmt='%.4f', delimiter='\t')
-        np.savetxt(self.save_path + '/roi.txt', self.roi, fmt='%.4f', delimiter='\t')
+        np.savez_compressed(self.save_path + '/results.npz', offsets=self.offsets, cyts=self.cyts, mems=self.mems,
+                            roi=self.roi)
+        if self.save_txt:
+            np.savetxt(self.save_path + '/offsets.txt', self.offsets, fmt='%.4f', delimiter='\t')
+            np.savetxt(self.save_path + '/cyts.txt', self.cyts, fmt='%.4f', delimiter='\t')
+            np.savetxt(self.save_path + '/mems.txt', self.mems, fmt='%.4f', delimiter='\t')
+            np.savetxt(self.save_path + '/roi.txt', self.roi, fmt='%.4f', delimiter='\t')
         save_img(self.img, self.save_path + '/img.tif')
         save_img(self.straight, self.save_path + '/straight.tif')
         # save_img(self.straight_filtered, self.save_path + '/straight_filtered.tif')